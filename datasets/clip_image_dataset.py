@@ -0,0 +1,17 @@
+from torch.utils.data import Dataset
+from PIL import Image
+
+
+class CLIPImageDataset(Dataset):
+
+    def __init__(self, image_paths, clip_preprocess):
+
+        self.image_paths = image_paths
+        self.clip_preprocess = clip_preprocess
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+
+        return self.clip_preprocess(Image.open(self.image_paths[index]))
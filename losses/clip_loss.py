@@ -1,15 +1,86 @@
 import torch
-import torchvision.transforms as transforms
 import torch.nn.functional as F
 
 import numpy as np
 
 import math
+import inspect
+import contextlib
+import functools
 import clip
-from PIL import Image
+from torch.utils.data import DataLoader
+from torch.utils.checkpoint import checkpoint
 from diffaug import DiffAugment
+from datasets.clip_image_dataset import CLIPImageDataset
 from utils.text_templates import imagenet_templates, part_templates, imagenet_templates_small
 
+# antialias is only available on newer PyTorch releases.
+INTERPOLATE_KWARGS = {'antialias': True} if 'antialias' in inspect.signature(F.interpolate).parameters else {}
+
+# Non-reentrant checkpointing is only available on newer PyTorch releases.
+CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+def sdpa_attention(block, x: torch.Tensor, is_causal: bool = False) -> torch.Tensor:
+    # Same computation as CLIP's ResidualAttentionBlock.attention, routed through the fused SDPA kernels.
+    seq_len, batch_size, width = x.shape
+    num_heads = block.attn.num_heads
+
+    q, k, v = F.linear(x, block.attn.in_proj_weight, block.attn.in_proj_bias).chunk(3, dim=-1)
+    q, k, v = [t.reshape(seq_len, batch_size, num_heads, width // num_heads).permute(1, 2, 0, 3) for t in (q, k, v)]
+
+    out = F.scaled_dot_product_attention(q, k, v, is_causal=is_causal)
+    out = out.permute(2, 0, 1, 3).reshape(seq_len, batch_size, width)
+
+    return block.attn.out_proj(out)
+
+def use_sdpa_attention(transformer, is_causal: bool = False) -> None:
+    for block in transformer.resblocks:
+        block.attention = functools.partial(sdpa_attention, block, is_causal=is_causal)
+
+def contrastive_chunk_lse(train_encoding: torch.Tensor, chunk: torch.Tensor, neg_mask: torch.Tensor, logit_scale: float) -> torch.Tensor:
+    # Masked columns use the lowest finite value rather than -inf, so a fully masked row cannot produce NaNs.
+    logits = (train_encoding @ chunk.T) * logit_scale
+    logits = logits.masked_fill(neg_mask, torch.finfo(logits.dtype).min)
+
+    return torch.logsumexp(logits, dim=-1)
+
+class CLIPPreprocess(torch.nn.Module):
+
+    def __init__(self, clip_preprocess):
+        super(CLIPPreprocess, self).__init__()
+
+        self.n_px = clip_preprocess.transforms[1].size[0] # CLIP's Resize + CenterCrop target size
+
+        # Un-normalize from [-1.0, 1.0] (GAN output) to [0, 1] and apply CLIP's Normalize as a single affine.
+        # Both are per-channel affines, which commute with the resize and crop.
+        mean = torch.tensor(clip_preprocess.transforms[-1].mean).view(1, -1, 1, 1)
+        std  = torch.tensor(clip_preprocess.transforms[-1].std).view(1, -1, 1, 1)
+
+        self.register_buffer('scale', 0.5 / std)
+        self.register_buffer('offset', (0.5 - mean) / std)
+
+    def resize(self, img: torch.Tensor) -> torch.Tensor:
+        height, width = img.shape[-2:]
+
+        if (height, width) == (self.n_px, self.n_px):
+            return img
+
+        # Resize the shorter side to n_px, then center crop, as torchvision's Resize + CenterCrop do.
+        if height <= width:
+            size = (self.n_px, int(self.n_px * width / height))
+        else:
+            size = (int(self.n_px * height / width), self.n_px)
+
+        img = F.interpolate(img, size=size, mode='bicubic', align_corners=False, **INTERPOLATE_KWARGS)
+
+        top  = int(round((size[0] - self.n_px) / 2.))
+        left = int(round((size[1] - self.n_px) / 2.))
+
+        return img[..., top:top + self.n_px, left:left + self.n_px]
+
+    def forward(self, img: torch.Tensor) -> torch.Tensor:
+        return torch.addcmul(self.offset, self.resize(img), self.scale)
+
 class DirectionLoss(torch.nn.Module):
 
     def __init__(self, loss_type='mse'):
@@ -30,17 +101,37 @@ class DirectionLoss(torch.nn.Module):
         return self.loss_func(x, y)
 
 class CLIPLoss(torch.nn.Module):
-    def __init__(self, device, lambda_direction=1., lambda_patch=0., lambda_global=0., lambda_manifold=0., lambda_texture=0., lambda_contrast=0., patch_loss_type='mae', direction_loss_type='cosine', clip_model='ViT-B/32'):
+    def __init__(self, device, lambda_direction=1., lambda_patch=0., lambda_global=0., lambda_manifold=0., lambda_texture=0., lambda_contrast=0., patch_loss_type='mae', direction_loss_type='cosine', clip_model='ViT-B/32', cache_image_features=False):
         super(CLIPLoss, self).__init__()
 
         self.device = device
         self.model, clip_preprocess = clip.load(clip_model, device=self.device)
 
+        # clip.load already casts the weights to fp16 on CUDA, only autocast when they were kept in fp32.
+        self.use_autocast = hasattr(torch, 'autocast') and torch.device(self.device).type == 'cuda' and self.model.dtype == torch.float32
+
+        # Captured frozen-CLIP image encodes, one CUDA graph per preprocessed input shape.
+        # Each graph pins its static input/output and a private memory pool for the whole ViT forward, and
+        # graphs are never evicted: the first max_cuda_graphs distinct no-grad shapes keep their slot for the
+        # lifetime of the loss, later shapes run eagerly. Pass graph=False for one-off encodes.
+        self.use_cuda_graphs = hasattr(torch.cuda, 'graph') and torch.device(self.device).type == 'cuda'
+        self.max_cuda_graphs = 4
+        self._graphs = {}
+
+        # The text tower's attention mask is the causal mask, the ViT attends to every token.
+        if hasattr(F, 'scaled_dot_product_attention'):
+            if hasattr(self.model.visual, 'transformer'):
+                use_sdpa_attention(self.model.visual.transformer)
+            use_sdpa_attention(self.model.transformer, is_causal=True)
+
+        # The CLIP towers are frozen, compile them once so the pointwise ops around the GEMMs get fused.
+        if hasattr(torch, 'compile') and torch.device(self.device).type == 'cuda':
+            self.model.visual = torch.compile(self.model.visual)
+            self.model.encode_text = torch.compile(self.model.encode_text)
+
         self.clip_preprocess = clip_preprocess
         
-        self.preprocess = transforms.Compose([transforms.Normalize(mean=[-1.0, -1.0, -1.0], std=[2.0, 2.0, 2.0])] + # Un-normalize from [-1.0, 1.0] (GAN output) to [0, 1].
-                                              clip_preprocess.transforms[:2] +                                      # to match CLIP input scale assumptions
-                                              clip_preprocess.transforms[4:])                                       # + skip convert PIL to tensor
+        self.preprocess = CLIPPreprocess(clip_preprocess).to(self.device)
 
         self.target_direction      = None
         self.patch_text_directions = None
@@ -57,6 +148,7 @@ class CLIPLoss(torch.nn.Module):
         self.lambda_contrast  = lambda_contrast
         
         self.neg_aug = True
+        self.contrast_chunk_size = 256
 
         self.src_text_features = None
         self.target_text_features = None
@@ -64,15 +156,90 @@ class CLIPLoss(torch.nn.Module):
 
         self.texture_loss = torch.nn.MSELoss()
 
+        # CLIP is frozen, so text features only depend on the prompt. Memoize them.
+        # Cached tensors are shared between callers and must not be modified in place.
+        self._text_feat_cache = {}
+        self._text_dir_cache  = {}
+        self._global_text_cache = {}
+
+        # Image features are only valid for the images of the current step, call reset_cache between steps.
+        # Off by default, since every cached entry keeps its input image alive until the reset.
+        self.cache_image_features = cache_image_features
+        self._feat_cache = {}
+
     def tokenize(self, strings: list):
         return clip.tokenize(strings).to(self.device)
 
+    @contextlib.contextmanager
+    def autocast(self):
+        if not self.use_autocast:
+            yield
+            return
+
+        # TF32 is a process-wide switch, only enable it for the CLIP encode and restore it afterwards
+        # so the generator and the other losses keep their fp32 numerics.
+        matmul_tf32, cudnn_tf32 = torch.backends.cuda.matmul.allow_tf32, torch.backends.cudnn.allow_tf32
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+        try:
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                yield
+        finally:
+            torch.backends.cuda.matmul.allow_tf32 = matmul_tf32
+            torch.backends.cudnn.allow_tf32 = cudnn_tf32
+
     def encode_text(self, tokens: list) -> torch.Tensor:
-        return self.model.encode_text(tokens)
+        with self.autocast():
+            text_features = self.model.encode_text(tokens)
+
+        return text_features.float()
+
+    def encode_images(self, images: torch.Tensor, graph: bool = True) -> torch.Tensor:
+        return self.encode_preprocessed_images(self.preprocess(images.to(self.device)), graph)
+
+    def encode_preprocessed_images(self, images: torch.Tensor, graph: bool = True) -> torch.Tensor:
+        # CUDA graphs only record the forward kernels, so encodes that need gradients stay eager.
+        # One-off encodes pass graph=False so they do not take one of the max_cuda_graphs slots.
+        if graph and self.use_cuda_graphs and not torch.is_grad_enabled():
+            if (images.shape, images.dtype) in self._graphs or len(self._graphs) < self.max_cuda_graphs:
+                return self.graphed_encode_images(images)
+
+        with self.autocast():
+            image_features = self.model.encode_image(images)
+
+        return image_features.float()
+
+    def graphed_encode_images(self, images: torch.Tensor) -> torch.Tensor:
+        key = (images.shape, images.dtype)
+
+        if key not in self._graphs:
+            static_images = images.clone()
 
-    def encode_images(self, images: torch.Tensor) -> torch.Tensor:
-        images = self.preprocess(images).to(self.device)
-        return self.model.encode_image(images)
+            # Warm up on a side stream before capturing, as required by torch.cuda.graph.
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream), self.autocast():
+                for _ in range(3):
+                    self.model.encode_image(static_images)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph), self.autocast():
+                static_features = self.model.encode_image(static_images)
+
+            self._graphs[key] = (graph, static_images, static_features)
+
+        graph, static_images, static_features = self._graphs[key]
+
+        static_images.copy_(images)
+        graph.replay()
+
+        # The next replay overwrites static_features, hand out a copy (.float() already copies fp16 features).
+        if static_features.dtype == torch.float32:
+            return static_features.clone()
+
+        return static_features.float()
     
     def distance_with_templates(self, img: torch.Tensor, class_str: str, templates=imagenet_templates) -> torch.Tensor:
 
@@ -84,45 +251,110 @@ class CLIPLoss(torch.nn.Module):
         return 1. - similarity
     
     def get_text_features(self, class_str: str, templates=imagenet_templates, norm: bool = True) -> torch.Tensor:
+        # Template lists are module-level constants, so their id identifies them.
+        key = (class_str, id(templates), norm)
+        if key in self._text_feat_cache:
+            return self._text_feat_cache[key]
+
         template_text = self.compose_text_with_templates(class_str, templates)
 
         tokens = clip.tokenize(template_text).to(self.device)
 
-        text_features = self.encode_text(tokens).detach()
+        with torch.no_grad():
+            text_features = self.encode_text(tokens)
 
         if norm:
             text_features /= text_features.norm(dim=-1, keepdim=True)
 
+        self._text_feat_cache[key] = text_features
+
         return text_features
 
+    def get_batched_text_features(self, class_strs: list, templates=imagenet_templates) -> torch.Tensor:
+        template_text = sum([self.compose_text_with_templates(class_str, templates) for class_str in class_strs], [])
+
+        tokens = clip.tokenize(template_text).to(self.device)
+
+        with torch.no_grad():
+            text_features = self.encode_text(tokens)
+
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+
+        return text_features.view(len(class_strs), len(templates), -1)
+
     def get_image_features(self, img: torch.Tensor, norm: bool = True) -> torch.Tensor:
-        image_features = self.encode_images(img)
-        
-        if norm:
-            image_features /= image_features.clone().norm(dim=-1, keepdim=True)
+        return self.get_batched_image_features(img, norm=norm)[0]
+
+    def get_batched_image_features(self, *imgs: torch.Tensor, norm: bool = True) -> list:
+        if not norm:
+            return self.encode_batched_images(imgs)
+
+        if not self.cache_image_features:
+            return [features / features.norm(dim=-1, keepdim=True) for features in self.encode_batched_images(imgs)]
+
+        # Normalized features are reused within a training step, see reset_cache.
+        keys    = [self.feature_cache_key(img) for img in imgs]
+        missing = {key: img for key, img in zip(keys, imgs) if key not in self._feat_cache}
+
+        if missing:
+            image_features = self.encode_batched_images(list(missing.values()))
+
+            for (key, img), features in zip(missing.items(), image_features):
+                self._feat_cache[key] = (img, features / features.norm(dim=-1, keepdim=True))
 
-        return image_features
+        return [self._feat_cache[key][1] for key in keys]
+
+    def encode_batched_images(self, imgs) -> list:
+        # Preprocess each tensor first, CLIPPreprocess always outputs n_px x n_px, so the images can be
+        # encoded in a single CLIP call whatever their input resolution and the cat runs on the small crops.
+        images = torch.cat([self.preprocess(img.to(self.device)) for img in imgs], dim=0)
+
+        image_features = self.encode_preprocessed_images(images)
+
+        return list(image_features.split([img.shape[0] for img in imgs], dim=0))
+
+    def feature_cache_key(self, img: torch.Tensor) -> tuple:
+        # The cached entry keeps img alive, so its storage cannot be reused while the key is in the cache.
+        # A tensor and its .detach() share storage and version, requires_grad tells them apart.
+        return (img.data_ptr(), img._version, img.shape, img.stride(), img.device, img.requires_grad, torch.is_grad_enabled())
+
+    def reset_cache(self) -> None:
+        self._feat_cache = {}
 
     def compute_text_direction(self, source_class: str, target_class: str) -> torch.Tensor:
+        # Directions are always built from imagenet_templates, so the class pair is enough as key.
+        key = (source_class, target_class)
+        if key in self._text_dir_cache:
+            return self._text_dir_cache[key]
+
         source_features = self.get_text_features(source_class)
         target_features = self.get_text_features(target_class)
 
         text_direction = (target_features - source_features).mean(axis=0, keepdim=True)
         text_direction /= text_direction.norm(dim=-1, keepdim=True)
 
+        self._text_dir_cache[key] = text_direction
+
         return text_direction
 
-    def compute_img2img_direction(self, source_images: torch.Tensor, target_images: list) -> torch.Tensor:
+    def compute_img2img_direction(self, source_images: torch.Tensor, target_images: list, batch_size: int = 64, num_workers: int = None) -> torch.Tensor:
+        # Worker processes only pay off once there is more than one batch to load, small target sets load in-process.
+        if num_workers is None:
+            num_workers = 0 if len(target_images) <= batch_size else 4
+
+        use_cuda = torch.device(self.device).type == 'cuda'
+        loader   = DataLoader(CLIPImageDataset(target_images, self.clip_preprocess), batch_size=batch_size, num_workers=num_workers, pin_memory=use_cuda)
+
         with torch.no_grad():
 
-            src_encoding = self.get_image_features(source_images)
+            src_encoding = self.encode_images(source_images, graph=False)
+            src_encoding = src_encoding / src_encoding.norm(dim=-1, keepdim=True)
             src_encoding = src_encoding.mean(dim=0, keepdim=True)
 
             target_encodings = []
-            for target_img in target_images:
-                preprocessed = self.clip_preprocess(Image.open(target_img)).unsqueeze(0).to(self.device)
-                
-                encoding = self.model.encode_image(preprocessed)
+            for preprocessed in loader:
+                with self.autocast():
+                    encoding = self.model.encode_image(preprocessed.to(self.device, non_blocking=use_cuda)).float()
                 encoding /= encoding.norm(dim=-1, keepdim=True)
 
                 target_encodings.append(encoding)
@@ -139,7 +371,7 @@ class CLIPLoss(torch.nn.Module):
     def contrastive_adaptation_loss(self, trainable_img: torch.Tensor, target_img: torch.Tensor, domain_labels = None) -> torch.Tensor:
 
         with torch.no_grad():
-            label_indices = torch.argmax(domain_labels[0], dim=1).cpu().tolist()
+            labels = torch.argmax(domain_labels[0], dim=1).to(self.device)
         
         replicate = 5
 
@@ -157,28 +389,39 @@ class CLIPLoss(torch.nn.Module):
         
         train_encoding = self.get_image_features(trainable_img)
         
-        loss = 0.
         temperature = 1.0
         logit_scale = 1.0/temperature
-        
-        loss_fn = torch.nn.CrossEntropyLoss()
-        for cur_encoding, cur_label in zip(train_encoding, label_indices):
-            cur_encoding = cur_encoding.unsqueeze(0)
-            pos_indices = [cur_label]
-            neg_indices = [i for i in range(len(aug_encodings)) if i not in [cur_label + n*len(target_img) for n in range(replicate)]]
-            pos_encodings = aug_encodings[pos_indices]
-            neg_encodings = aug_encodings[neg_indices]
-            total_encodings = torch.cat([pos_encodings, neg_encodings])
-            sim_matrix = cur_encoding @ total_encodings.T 
-            labels = torch.zeros(sim_matrix.shape[0], dtype=torch.int64).to(self.device)
-            labels[0] = 0
-
-            logits = sim_matrix * logit_scale
-            loss += loss_fn(logits, labels)
-            
-        
-        loss /= len(train_encoding)
-        
+
+        pos_logits     = (train_encoding * aug_encodings[labels]).sum(dim=-1) * logit_scale
+        replicate_cols = labels[:, None] + torch.arange(replicate, device=self.device)[None, :] * len(target_img)
+
+        # Every replicate of a sample's own target is dropped from its negatives, except the positive itself.
+        # Replicates past the last augmented encoding are scattered into a spare column that is sliced off.
+        num_aug  = len(aug_encodings)
+        neg_mask = torch.zeros(len(labels), num_aug + 1, dtype=torch.bool, device=self.device)
+        neg_mask.scatter_(1, replicate_cols.clamp(max=num_aug), True)
+        neg_mask.scatter_(1, labels[:, None], False)
+        neg_mask = neg_mask[:, :num_aug]
+
+        # Accumulate the log-sum-exp over chunks of augmented encodings. When a grad is needed each chunk is
+        # checkpointed and recomputed in backward, so only one [B, chunk] block of logits is alive at a time.
+        chunk_lse_fn = functools.partial(contrastive_chunk_lse, logit_scale=logit_scale)
+        use_checkpoint = torch.is_grad_enabled() and train_encoding.requires_grad
+
+        lse = None
+        for start in range(0, num_aug, self.contrast_chunk_size):
+            chunk      = aug_encodings[start:start + self.contrast_chunk_size]
+            chunk_mask = neg_mask[:, start:start + len(chunk)]
+
+            if use_checkpoint:
+                chunk_lse = checkpoint(chunk_lse_fn, train_encoding, chunk, chunk_mask, **CHECKPOINT_KWARGS)
+            else:
+                chunk_lse = chunk_lse_fn(train_encoding, chunk, chunk_mask)
+
+            lse = chunk_lse if lse is None else torch.logaddexp(lse, chunk_lse)
+
+        loss = (lse - pos_logits).mean()
+
         return loss
 
 
@@ -194,16 +437,15 @@ class CLIPLoss(torch.nn.Module):
             self.set_text_features(source_class, target_class)
 
         cos_text_angle = self.target_text_features @ self.src_text_features.T
-        text_angle = torch.acos(cos_text_angle)
 
-        src_img_features = self.get_image_features(src_img).unsqueeze(2)
-        target_img_features = self.get_image_features(target_img).unsqueeze(1)
+        src_img_features, target_img_features = self.get_batched_image_features(src_img, target_img)
+        src_img_features = src_img_features.unsqueeze(2)
+        target_img_features = target_img_features.unsqueeze(1)
 
         cos_img_angle = torch.clamp(target_img_features @ src_img_features, min=-1.0, max=1.0)
-        img_angle = torch.acos(cos_img_angle)
 
-        text_angle = text_angle.unsqueeze(0).repeat(img_angle.size()[0], 1, 1)
-        cos_text_angle = cos_text_angle.unsqueeze(0).repeat(img_angle.size()[0], 1, 1)
+        # expand_as broadcasts the text angle over the batch without materializing a copy.
+        cos_text_angle = cos_text_angle.unsqueeze(0).expand_as(cos_img_angle)
 
         return self.angle_loss(cos_img_angle, cos_text_angle)
 
@@ -226,17 +468,14 @@ class CLIPLoss(torch.nn.Module):
 
     def domain_clip_directional_loss(self, src_img: torch.Tensor, old_img: torch.Tensor, target_img: torch.Tensor, new_img: torch.Tensor) -> torch.Tensor:
 
-        src_encoding = self.get_image_features(src_img)
-        target_encoding = self.get_image_features(target_img)
-        edit_direction = (target_encoding - src_encoding)
-        edit_direction /= edit_direction.clone().norm(dim=-1, keepdim=True)
+        src_encoding, target_encoding, old_encoding, new_encoding = self.get_batched_image_features(src_img, target_img, old_img, new_img)
 
+        edit_direction = (target_encoding - src_encoding)
+        edit_direction = edit_direction / edit_direction.norm(dim=-1, keepdim=True)
 
-        old_encoding = self.get_image_features(old_img)
-        new_encoding = self.get_image_features(new_img)
 
         target_direction = (new_encoding - old_encoding)
-        target_direction /= target_direction.clone().norm(dim=-1, keepdim=True)
+        target_direction = target_direction / target_direction.norm(dim=-1, keepdim=True)
 
         # target_direction = self.target_direction
 
@@ -245,20 +484,13 @@ class CLIPLoss(torch.nn.Module):
 
     def in_clip_directional_loss(self, src_img: torch.Tensor, old_img: torch.Tensor, target_img: torch.Tensor, new_img: torch.Tensor) -> torch.Tensor:
 
-        src_encoding = self.get_image_features(src_img)
-        target_encoding = self.get_image_features(target_img)
-
-
-        old_encoding = self.get_image_features(old_img)
-        new_encoding = self.get_image_features(new_img)
-
-
+        src_encoding, target_encoding, old_encoding, new_encoding = self.get_batched_image_features(src_img, target_img, old_img, new_img)
 
         edit_direction = (target_encoding - new_encoding)
-        edit_direction /= edit_direction.clone().norm(dim=-1, keepdim=True)
+        edit_direction = edit_direction / edit_direction.norm(dim=-1, keepdim=True)
 
         target_direction = (src_encoding - old_encoding)
-        target_direction /= target_direction.clone().norm(dim=-1, keepdim=True)
+        target_direction = target_direction / target_direction.norm(dim=-1, keepdim=True)
         return self.direction_loss(edit_direction, target_direction).mean()
 
 
@@ -267,20 +499,28 @@ class CLIPLoss(torch.nn.Module):
     def global_clip_loss(self, img: torch.Tensor, text) -> torch.Tensor:
         if not isinstance(text, list):
             text = [text]
-            
-        tokens = clip.tokenize(text).to(self.device)
-        image  = self.preprocess(img)
 
-        logits_per_image, _ = self.model(image, tokens)
+        key = tuple(text)
+        if key not in self._global_text_cache:
+            with torch.no_grad():
+                text_features = self.encode_text(self.tokenize(text))
+            self._global_text_cache[key] = text_features / text_features.norm(dim=-1, keepdim=True)
+
+        text_features  = self._global_text_cache[key]
+        image_features = self.get_image_features(img)
+
+        logits_per_image = self.model.logit_scale.exp() * image_features @ text_features.T
 
         return (1. - logits_per_image / 100).mean()
 
-    def random_patch_centers(self, img_shape, num_patches, size):
+    def random_patch_centers(self, img_shape, num_patches, size, device=None):
         batch_size, channels, height, width = img_shape
 
+        device = self.device if device is None else device
+
         half_size = size // 2
-        patch_centers = np.concatenate([np.random.randint(half_size, width - half_size,  size=(batch_size * num_patches, 1)),
-                                        np.random.randint(half_size, height - half_size, size=(batch_size * num_patches, 1))], axis=1)
+        patch_centers = torch.cat([torch.randint(half_size, width - half_size,  size=(batch_size * num_patches, 1), device=device),
+                                   torch.randint(half_size, height - half_size, size=(batch_size * num_patches, 1), device=device)], dim=1)
 
         return patch_centers
 
@@ -289,27 +529,25 @@ class CLIPLoss(torch.nn.Module):
         num_patches = len(patch_centers) // batch_size
         half_size   = size // 2
 
-        patches = []
+        patch_centers = torch.as_tensor(patch_centers, device=img.device)
+        offsets       = torch.arange(2 * half_size, device=img.device)
 
-        for batch_idx in range(batch_size):
-            for patch_idx in range(num_patches):
+        # Gather every patch in one advanced-indexing op instead of slicing them one by one.
+        rows      = (patch_centers[:, 1] - half_size)[:, None] + offsets
+        cols      = (patch_centers[:, 0] - half_size)[:, None] + offsets
+        batch_idx = torch.arange(batch_size, device=img.device).repeat_interleave(num_patches)
 
-                center_x = patch_centers[batch_idx * num_patches + patch_idx][0]
-                center_y = patch_centers[batch_idx * num_patches + patch_idx][1]
+        patches = img[batch_idx[:, None, None], :, rows[:, :, None], cols[:, None, :]]
 
-                patch = img[batch_idx:batch_idx+1, :, center_y - half_size:center_y + half_size, center_x - half_size:center_x + half_size]
+        return patches.permute(0, 3, 1, 2)
 
-                patches.append(patch)
-
-        patches = torch.cat(patches, axis=0)
-
-        return patches
+    def get_part_text_features(self, class_str: str) -> torch.Tensor:
+        # Un-normalized, as patch_scores has always compared against raw part features. Memoized per class_str.
+        return self.get_text_features(class_str, part_templates, norm=False)
 
     def patch_scores(self, img: torch.Tensor, class_str: str, patch_centers, patch_size: int) -> torch.Tensor:
 
-        parts = self.compose_text_with_templates(class_str, part_templates)    
-        tokens = clip.tokenize(parts).to(self.device)
-        text_features = self.encode_text(tokens).detach()
+        text_features = self.get_part_text_features(class_str)
 
         patches        = self.generate_patches(img, patch_centers, patch_size)
         image_features = self.get_image_features(patches)
@@ -321,10 +559,14 @@ class CLIPLoss(torch.nn.Module):
     def clip_patch_similarity(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_class: str) -> torch.Tensor:
         patch_size = 196 #TODO remove magic number
 
-        patch_centers = self.random_patch_centers(src_img.shape, 4, patch_size) #TODO remove magic number
-   
-        src_scores    = self.patch_scores(src_img, source_class, patch_centers, patch_size)
-        target_scores = self.patch_scores(target_img, target_class, patch_centers, patch_size)
+        patch_centers = self.random_patch_centers(src_img.shape, 4, patch_size, src_img.device) #TODO remove magic number
+
+        # Encode source and target patches in one CLIP call.
+        src_features, target_features = self.get_batched_image_features(self.generate_patches(src_img, patch_centers, patch_size),
+                                                                        self.generate_patches(target_img, patch_centers, patch_size))
+
+        src_scores    = src_features @ self.get_part_text_features(source_class).T
+        target_scores = target_features @ self.get_part_text_features(target_class).T
 
         return self.patch_loss(src_scores, target_scores)
 
@@ -334,22 +576,22 @@ class CLIPLoss(torch.nn.Module):
             src_part_classes = self.compose_text_with_templates(source_class, part_templates)
             target_part_classes = self.compose_text_with_templates(target_class, part_templates)
 
-            parts_classes = list(zip(src_part_classes, target_part_classes))
+            # Same as compute_text_direction per (source, target) part pair, with one text encode per side.
+            src_part_features    = self.get_batched_text_features(src_part_classes)
+            target_part_features = self.get_batched_text_features(target_part_classes)
 
-            self.patch_text_directions = torch.cat([self.compute_text_direction(pair[0], pair[1]) for pair in parts_classes], dim=0)
+            self.patch_text_directions = (target_part_features - src_part_features).mean(dim=1)
+            self.patch_text_directions = self.patch_text_directions / self.patch_text_directions.norm(dim=-1, keepdim=True)
 
         patch_size = 510 # TODO remove magic numbers
 
-        patch_centers = self.random_patch_centers(src_img.shape, 1, patch_size)
-
-        patches = self.generate_patches(src_img, patch_centers, patch_size)
-        src_features = self.get_image_features(patches)
+        patch_centers = self.random_patch_centers(src_img.shape, 1, patch_size, src_img.device)
 
-        patches = self.generate_patches(target_img, patch_centers, patch_size)
-        target_features = self.get_image_features(patches)
+        src_features, target_features = self.get_batched_image_features(self.generate_patches(src_img, patch_centers, patch_size),
+                                                                        self.generate_patches(target_img, patch_centers, patch_size))
 
         edit_direction = (target_features - src_features)
-        edit_direction /= edit_direction.clone().norm(dim=-1, keepdim=True)
+        edit_direction = edit_direction / edit_direction.norm(dim=-1, keepdim=True)
 
         cosine_dists = 1. - self.patch_direction_loss(edit_direction.unsqueeze(1), self.patch_text_directions.unsqueeze(0))
 
@@ -396,11 +638,10 @@ class CLIPLoss(torch.nn.Module):
 
     def rec_loss(self, rec_img, new_img):
 
-        rec_encoding = self.get_image_features(rec_img)
-        new_encoding = self.get_image_features(new_img)
+        rec_encoding, new_encoding = self.get_batched_image_features(rec_img, new_img)
 
-        rec_encoding /= rec_encoding.clone().norm(dim=-1, keepdim=True)
-        new_encoding /= new_encoding.clone().norm(dim=-1, keepdim=True)
+        rec_encoding = rec_encoding / rec_encoding.norm(dim=-1, keepdim=True)
+        new_encoding = new_encoding / new_encoding.norm(dim=-1, keepdim=True)
 
         loss = self.direction_loss(rec_encoding, new_encoding).mean()
 
@@ -171,7 +171,8 @@ class DynaGAN(torch.nn.Module):
                                                       lambda_manifold=args.lambda_manifold,
                                                       lambda_texture=args.lambda_texture,
                                                       lambda_contrast=args.lambda_contrast,
-                                                      clip_model=model_name)
+                                                      clip_model=model_name,
+                                                      cache_image_features=True)
                                  for model_name in args.clip_models}
 
         self.clip_model_weights = {model_name: weight for model_name, weight in
@@ -325,5 +326,9 @@ class DynaGAN(torch.nn.Module):
                    self.args.lpips_lambda * lpips_loss + self.args.l2_lambda * l2_loss + self.args.clip_within_lambda * clip_within_loss + \
                        self.args.lambda_contrast * contrastive_loss + self.args.lambda_id * id_loss
 
+            # The loss graph holds what it needs, release the cached images and features of this step.
+            for clip_loss_model in self.clip_loss_models.values():
+                clip_loss_model.reset_cache()
+
             return [trainable_img, None, None, None], loss
 
@@ -186,7 +186,8 @@ class DynaGAN(torch.nn.Module):
                                                       lambda_manifold=args.lambda_manifold,
                                                       lambda_texture=args.lambda_texture,
                                                       lambda_contrast=args.lambda_contrast,
-                                                      clip_model=model_name)
+                                                      clip_model=model_name,
+                                                      cache_image_features=True)
                                  for model_name in args.clip_models}
 
         self.clip_model_weights = {model_name: weight for model_name, weight in
@@ -232,7 +233,8 @@ class DynaGAN(torch.nn.Module):
             ZP_img_tensor = 2.0 * torchvision.transforms.ToTensor()(ZP_input_img_1024).unsqueeze(0).cuda() - 1.0
             ZP_imgs_tensor.append(ZP_img_tensor)
             
-            ZP_img_clip_embed = self.clip_loss_models["ViT-B/16"].encode_images(ZP_img_tensor).to(torch.float32)
+            with torch.no_grad():
+                ZP_img_clip_embed = self.clip_loss_models["ViT-B/16"].encode_images(ZP_img_tensor, graph=False).to(torch.float32)
             ZP_imgs_clip_embed.append(ZP_img_clip_embed)
             
             ZP_img_tensor_256 = 2.0 * torchvision.transforms.ToTensor()(ZP_input_img_256).unsqueeze(0).cuda() - 1.0
@@ -365,5 +367,9 @@ class DynaGAN(torch.nn.Module):
                    self.args.lpips_lambda * lpips_loss + self.args.l2_lambda * l2_loss + self.args.clip_within_lambda * clip_within_loss + \
                        self.args.lambda_contrast * contrastive_loss + self.args.lambda_id * id_loss
 
+            # The loss graph holds what it needs, release the cached images and features of this step.
+            for clip_loss_model in self.clip_loss_models.values():
+                clip_loss_model.reset_cache()
+
             return [trainable_img, None, None, None], loss
 